@@ -1,53 +1,142 @@
-import base64
+import binascii
 import contextlib
 import os
-import random
 import re
 import time
-from json import dumps
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import Response
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException as TE, NoSuchElementException
+from selenium.webdriver import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait as WDW
+from urllib3.util.retry import Retry
 
-# Captcha xpath selectors.
-CHECKBOX_CHALLENGE: str = "(//iframe[contains(@title,'checkbox')])[1]"
-HOOK_CHALLENGE: str = "(//iframe[contains(@title,'content')])[1]"
-PROMPT_TEXT: str = "(//h2[@class='prompt-text'])[1]"
-CAPTCHA_CANVAS: str = "(//canvas)[1]"
-CAPTCHA_SUBMIT_BUTTON: str = "(//div[@class='button-submit button'])[1]"
-CAPTCHA_REFRESH_BUTTON: str = "(//div[@class='refresh button'])[1]"
-TASK_IMAGE: str = "//div[@class='task-image']"
-
-NOCAPTCHAAI_ENDPOINTS: dict[str, list[str]] = {
-    "free": [
-        "https://free.nocaptchaai.com/balance",
-        "https://free.nocaptchaai.com/solve",
-    ],
-    "pro": [
-        "https://manage.nocaptchaai.com/balance",
-        "https://pro.nocaptchaai.com/solve",
-        "https://pro.nocaptchaai.com/status",
-    ],
+# Use orjson for the (large) API payloads when it's installed.
+try:
+    import orjson
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+except ImportError:
+    from json import dumps, loads
+
+# Captcha css selectors, as (By, value) locators.
+CHECKBOX_CHALLENGE: tuple[str, str] = (By.CSS_SELECTOR, "iframe[title*='checkbox']")
+HOOK_CHALLENGE: tuple[str, str] = (By.CSS_SELECTOR, "iframe[title*='content']")
+PROMPT_TEXT: tuple[str, str] = (By.CSS_SELECTOR, "h2.prompt-text")
+CAPTCHA_CANVAS: tuple[str, str] = (By.CSS_SELECTOR, "canvas")
+CAPTCHA_SUBMIT_BUTTON: tuple[str, str] = (By.CSS_SELECTOR, "div.button-submit.button")
+CAPTCHA_REFRESH_BUTTON: tuple[str, str] = (By.CSS_SELECTOR, "div.refresh.button")
+TASK_IMAGE: tuple[str, str] = (By.CSS_SELECTOR, "div.task-image")
+
+# Extracts the image url from the background of a grid image.
+_BG_URL_RE: re.Pattern = re.compile(r"url\([\"']?([^\"')]+)")
+
+
+@dataclass(frozen=True, slots=True)
+class _Endpoints:
+    """
+    The NoCaptchaAI endpoints of a plan.
+    """
+
+    balance: str
+    solve: str
+    status: str | None = None
+
+
+NOCAPTCHAAI_ENDPOINTS: dict[str, _Endpoints] = {
+    "free": _Endpoints(
+        balance="https://free.nocaptchaai.com/balance",
+        solve="https://free.nocaptchaai.com/solve",
+    ),
+    "pro": _Endpoints(
+        balance="https://manage.nocaptchaai.com/balance",
+        solve="https://pro.nocaptchaai.com/solve",
+        status="https://pro.nocaptchaai.com/status",
+    ),
 }
 
-GRID_CHALLENGE_PROMPTS: list[str] = [
+GRID_CHALLENGE_PROMPTS: tuple[str, ...] = (
     "please click each image containing",
     "please click on all images containing",
-]
+)
 
-BOUNDING_BOX_CHALLENGE_PROMPTS: list[str] = [
+BOUNDING_BOX_CHALLENGE_PROMPTS: tuple[str, ...] = (
     "please click the center of the",
     "please click on the",
-]
+)
+
+MULTIPLE_CHOICE_CHALLENGE_PROMPTS: tuple[str, ...] = ("select the most accurate description of the image",)
+
+# Captcha type for each list of prompts, checked in order.
+_PROMPT_TABLE: tuple[tuple[int, tuple[str, ...]], ...] = (
+    (0, GRID_CHALLENGE_PROMPTS),
+    (1, BOUNDING_BOX_CHALLENGE_PROMPTS),
+    (2, MULTIPLE_CHOICE_CHALLENGE_PROMPTS),
+)
+
+# Statuses from the API that mean the captcha has to be refreshed.
+_BAD_STATUSES: frozenset[str] = frozenset({"skip", "error"})
+
+# Headers used to download the grid images, the user agent is added by the solver.
+_IMG_GET_HEADERS: dict[str, str] = {
+    "Authority": "hcaptcha.com",
+    "Accept": "application/json",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Content-Type": "application/json",
+    "Origin": "https://newassets.hcaptcha.com/",
+    "Sec-Fetch-Site": "same-site",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Dest": "empty",
+}
+
+# (connect, read) timeout used for every HTTP request.
+REQUEST_TIMEOUT: tuple[float, float] = (1.0, 3.0)
+
+# Transient failures retried by urllib3 on the pooled connections.
+# Once the retries run out the last response is returned, so callers can still check its status.
+# Read timeouts aren't retried, the solve request may have reached the API (and been charged) already.
+REQUEST_RETRY: Retry = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.2,
+    status_forcelist=[502, 503, 504, 522, 524],
+    allowed_methods=frozenset(["GET", "POST"]),
+    raise_on_status=False,
+)
 
-MULTIPLE_CHOICE_CHALLENGE_PROMPTS: list[str] = [
-    "select the most accurate description of the image",
-]
+# Polling settings used while waiting for a bounding box solution.
+SOLUTION_POLL_DELAY: float = 0.15
+SOLUTION_POLL_MAX_DELAY: float = 0.4
+SOLUTION_POLL_TIMEOUT: float = 30
+
+# Seconds between each check of an explicit wait, the timeouts used are only a few seconds.
+WAIT_POLL_FREQUENCY: float = 0.1
+
+# Seconds to back off when a challenge couldn't be read, before trying again.
+RETRY_DELAY: float = 1
+
+# Seconds to wait for hCaptcha to load a new challenge after clicking refresh.
+REFRESH_DELAY: float = 1
+
+# Seconds to wait for hCaptcha to replace a submitted round.
+ROUND_CHANGE_TIMEOUT: float = 3
+
+# Number of downloaded grid images kept in memory, hCaptcha reuses images between rounds.
+TILE_CACHE_SIZE: int = 128
+
+# Seconds before the balance is requested again from the API.
+BALANCE_CHECK_TTL: float = 30
 
 
 class Solver:
@@ -61,11 +150,12 @@ class Solver:
     """
 
     driver: webdriver = None
-    user_agent: str
+    user_agent: str | None = None
 
     api_key: str
     api_url: str
-    api_endpoints: list[str]
+    api_plan: str
+    ep: _Endpoints
 
     api_error: bool = False
     balance: int = 0
@@ -76,11 +166,73 @@ class Solver:
     captcha_type: int | None = None
 
     captcha_frame = None
+    _in_frame: bool = False
+    _challenge_ready: bool = False
+
+    _post_headers: dict[str, str]
+    _poll_headers: dict[str, str]
+    _balance_headers: dict[str, str]
+    _tile_headers: dict[str, str]
+    _ua_by_driver: weakref.WeakKeyDictionary
+
+    _session: requests.Session
+    _executor: ThreadPoolExecutor
+    _tile_cache: OrderedDict[str, str]
+    _balance_checked_at: float | None = None
 
     def __init__(self, api_key: str = None, api_url: str = None) -> None:
         self.api_key = api_key if api_key is not None else os.getenv("API_KEY")
         self.api_url = api_url if api_url is not None else os.getenv("API_URL")
-        self.api_endpoints = NOCAPTCHAAI_ENDPOINTS[self.api_url]
+
+        # The api_url can either be the plan name ("free" or "pro") or a full url of that plan.
+        # Anything without "free" in it (typos included) uses the pro endpoints.
+        self.api_plan = "free" if "free" in self.api_url else "pro"
+        self.ep = NOCAPTCHAAI_ENDPOINTS[self.api_plan]
+
+        # These never change for the solver, so build them only once.
+        self._post_headers = {"Content-Type": "application/json", "apikey": self.api_key}
+        self._poll_headers = {
+            "Accept-Language": "last-requested-languages",
+            "apikey": self.api_key,
+        }
+        self._balance_headers = {"apikey": self.api_key}
+
+        # Shared session so connections to hCaptcha and the API are kept alive.
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(max_retries=REQUEST_RETRY, pool_connections=16, pool_maxsize=16),
+        )
+
+        # Kept for the lifetime of the solver so the worker threads are reused between challenges.
+        self._executor = ThreadPoolExecutor(max_workers=9)
+
+        # The user agent doesn't change during the lifetime of a driver.
+        # Weak keys, so closed drivers don't keep their entry around.
+        self._ua_by_driver = weakref.WeakKeyDictionary()
+
+        # Base64 of the last downloaded grid images, keyed by url.
+        self._tile_cache = OrderedDict()
+
+    def close(
+        self,
+    ) -> None:
+        """
+        Releases the worker threads and the HTTP connections of the solver.
+        """
+        self._executor.shutdown()
+        self._session.close()
+
+    def __enter__(
+        self,
+    ) -> "Solver":
+        return self
+
+    def __exit__(
+        self,
+        *exc_info,
+    ) -> None:
+        self.close()
 
     def identify_challenge(
         self,
@@ -94,14 +246,31 @@ class Solver:
         """
         target: str = self.target.lower().strip()
 
-        # TODO Improve method of checking captcha version.
-        # Check if keywords are present in the target.
-        if any(keyword in target for keyword in GRID_CHALLENGE_PROMPTS):
-            self.captcha_type = 0
-        if any(keyword in target for keyword in BOUNDING_BOX_CHALLENGE_PROMPTS):
-            self.captcha_type = 1
-        if any(keyword in target for keyword in MULTIPLE_CHOICE_CHALLENGE_PROMPTS):
-            self.captcha_type = 2
+        # A challenge that isn't recognized shouldn't keep the type of the previous one.
+        self.captcha_type = None
+
+        # Check if keywords are present in the target, the first match decides the captcha type.
+        for captcha_type, prompts in _PROMPT_TABLE:
+            if any(keyword in target for keyword in prompts):
+                self.captcha_type = captcha_type
+                return
+
+    def _wait(
+        self,
+        timeout: float,
+        poll: float = WAIT_POLL_FREQUENCY,
+    ) -> WDW:
+        """
+        Creates an explicit wait that polls more often than the Selenium default (0.5 s).
+
+        Args:
+            timeout (float): Seconds to wait before timing out.
+            poll (float): Seconds between each check.
+
+        Returns:
+            WebDriverWait: The explicit wait for the current driver.
+        """
+        return WDW(self.driver, timeout, poll_frequency=poll)
 
     def is_challenge_image_clickable(
         self,
@@ -109,18 +278,134 @@ class Solver:
     ) -> bool:
         """
         Checks if the challenge image is clickable.
+        The iframe found is kept in captcha_frame, so it doesn't have to be looked up again.
 
         Returns:
             bool: True if the challenge image is clickable, False otherwise.
         """
         try:
-            WDW(self.driver, wait).until(
-                EC.element_to_be_clickable((By.XPATH, HOOK_CHALLENGE)),
+            self.captcha_frame = self._wait(wait).until(
+                EC.element_to_be_clickable(HOOK_CHALLENGE),
             )
             return True
         except TE:
             return False
 
+    def _enter_frame(
+        self,
+    ) -> None:
+        """
+        Switches to the captcha iframe, unless the driver is already in it.
+        """
+        if not self._in_frame:
+            self.driver.switch_to.frame(self.captcha_frame)
+            self._in_frame = True
+
+    def _leave_frame(
+        self,
+    ) -> None:
+        """
+        Goes back to the main frame, unless the driver is already in it.
+        """
+        if self._in_frame:
+            self.driver.switch_to.default_content()
+            self._in_frame = False
+
+    def is_challenge_image_present(
+        self,
+    ) -> bool:
+        """
+        Checks if the challenge iframe is present and visible, using a single script call.
+
+        Returns:
+            bool: True if the challenge iframe is visible, False otherwise.
+        """
+        return self.driver.execute_script(
+            """
+            const frame = document.querySelector(arguments[0]);
+            return !!frame && frame.offsetHeight > 0 && getComputedStyle(frame).visibility !== "hidden";
+            """,
+            HOOK_CHALLENGE[1],
+        )
+
+    def is_challenge_ready(
+        self,
+    ) -> bool:
+        """
+        Checks if the challenge can be solved. Right after is_captcha_visible this is already known,
+        otherwise (e.g. on a "Next Challenge" step, after wait_for_round_change) the page is checked again.
+
+        Returns:
+            bool: True if the challenge can be solved, False otherwise.
+        """
+        if self._challenge_ready:
+            self._challenge_ready = False
+            return True
+
+        return self.is_challenge_image_present()
+
+    def challenge_signature(
+        self,
+    ) -> str:
+        """
+        Gets a value that changes when hCaptcha loads a new round, using a single script call.
+        It's made from the style of the grid images or, on bounding box challenges, from a thumbnail of the canvas.
+        Must be called inside the captcha iframe.
+
+        Returns:
+            str: The signature of the current round.
+        """
+        return self.driver.execute_script(
+            """
+            const [imageSelector, canvasSelector] = arguments;
+
+            const styles = Array.from(
+                document.querySelectorAll(imageSelector),
+                (image) => image.getAttribute("style"),
+            ).join("|");
+            if (styles) return styles;
+
+            const canvas = document.querySelector(canvasSelector);
+            if (!canvas || !canvas.width || !canvas.height) return "";
+
+            // A tiny copy of the canvas is enough to tell if it was redrawn.
+            const thumbnail = document.createElement("canvas");
+            Object.assign(thumbnail, { width: 16, height: 16 });
+            thumbnail.getContext("2d").drawImage(canvas, 0, 0, 16, 16);
+            return thumbnail.toDataURL();
+            """,
+            f"{TASK_IMAGE[1]} .image",
+            CAPTCHA_CANVAS[1],
+        )
+
+    def wait_for_round_change(
+        self,
+        signature: str,
+    ) -> None:
+        """
+        Waits until a submitted round is gone, either because the challenge was closed
+        or because hCaptcha loaded a new round. Ends in the main frame.
+
+        Args:
+            signature (str): The challenge_signature of the submitted round.
+        """
+
+        def round_changed(_) -> bool:
+            self._leave_frame()
+
+            if not self.is_challenge_image_present():
+                return True
+
+            self._enter_frame()
+
+            return self.challenge_signature() != signature
+
+        # If nothing changes in time, carry on anyway and let the next checks decide.
+        with contextlib.suppress(TE):
+            self._wait(ROUND_CHANGE_TIMEOUT).until(round_changed)
+
+        self._leave_frame()
+
     def is_captcha_visible(
         self,
     ) -> bool:
@@ -132,39 +417,94 @@ class Solver:
         Returns:
             bool: True if the captcha is visible, False otherwise.
         """
+        # The checks below run on the main frame.
+        self._leave_frame()
+
         already_visible: bool = bool(self.is_challenge_image_clickable(wait=1))
 
         if not already_visible:
             # Check if the checkbox is visible.
             with contextlib.suppress(TE, NoSuchElementException):
-                WDW(self.driver, 1).until(
-                    EC.element_to_be_clickable((By.XPATH, CHECKBOX_CHALLENGE)),
+                self._wait(1).until(
+                    EC.element_to_be_clickable(CHECKBOX_CHALLENGE),
                 ).click()
 
-                time.sleep(1)
-
+            # Wait for the challenge to show up after the click.
             # This could mean that simply clicking the checkbox solved the captcha.
             if not self.is_challenge_image_clickable(wait=3):
                 return False
 
-        WDW(self.driver, 2).until(
-            EC.presence_of_all_elements_located((By.XPATH, HOOK_CHALLENGE)),
+        # Switch to the captcha iframe found by is_challenge_image_clickable.
+        self._enter_frame()
+
+        # Get the target text.
+        prompt = self._wait(2).until(
+            EC.visibility_of_element_located(PROMPT_TEXT),
         )
+        self.target = prompt.text
 
-        # Switch to the captcha iframe.
-        self.captcha_frame = self.driver.find_element(By.XPATH, HOOK_CHALLENGE)
+        # Stay in the captcha iframe, the solvers work inside of it.
+        self._challenge_ready = True
 
-        self.driver.switch_to.frame(self.captcha_frame)
+        return True
 
-        time.sleep(0.5)
+    def fetch_images(
+        self,
+        urls: list[str],
+        headers: dict[str, str],
+    ) -> dict[int, str] | None:
+        """
+        Downloads all the images concurrently and encodes them in base64.
+        Images that were recently downloaded are taken from the cache instead.
 
-        # Get the target text.
-        self.target = self.driver.find_element(By.XPATH, PROMPT_TEXT).text
+        Args:
+            urls (list[str]): The urls of the images.
+            headers (dict[str, str]): The headers to send with each request.
 
-        # Go back to the main frame.
-        self.driver.switch_to.default_content()
+        Returns:
+            dict[int, str] | None: The base64 of each image, keyed by its index.
+                None if any of the images couldn't be downloaded.
+        """
+        # Filled by index, so the images keep their original order.
+        encoded: list[str | None] = [None] * len(urls)
+        futures = {}
 
-        return True
+        for index, url in enumerate(urls):
+            if url in self._tile_cache:
+                self._tile_cache.move_to_end(url)
+                encoded[index] = self._tile_cache[url]
+                continue
+
+            futures[self._executor.submit(self._session.get, url, headers=headers, timeout=REQUEST_TIMEOUT)] = index
+
+        failed: bool = False
+
+        for future in as_completed(futures):
+            index: int = futures[future]
+
+            try:
+                response: Response = future.result()
+            except requests.RequestException:
+                failed = True
+                continue
+
+            # Error pages are not images, so they are neither sent nor cached.
+            if not response.ok:
+                failed = True
+                continue
+
+            # Base64 output is always ASCII, so skip the UTF-8 decoder.
+            encoded[index] = binascii.b2a_base64(response.content, newline=False).decode("ascii")
+
+            self._tile_cache[urls[index]] = encoded[index]
+            if len(self._tile_cache) > TILE_CACHE_SIZE:
+                self._tile_cache.popitem(last=False)
+
+        if failed:
+            return None
+
+        # The API expects an object keyed by the index of each image.
+        return dict(enumerate(encoded))
 
     def solve_hcaptcha_grid(
         self,
@@ -172,104 +512,118 @@ class Solver:
         """
         Solves the captcha challenge of type Grid (type = 0).
         """
-        time.sleep(1)
+        # Loop while there are more steps ("Next Challenge") to solve.
+        while True:
+            if not self.is_challenge_ready():
+                self.solved = True
+                return
 
-        if not self.is_challenge_image_clickable(wait=1):
-            self.solved = True
-            return
+            # Switch to the captcha iframe.
+            self._enter_frame()
 
-        # Switch to the captcha iframe.
-        self.captcha_frame = self.driver.find_element(By.XPATH, HOOK_CHALLENGE)
+            # Getting the style of every image in a single call, the url is inside of it.
+            image_styles: list[str | None] = self.driver.execute_script(
+                """
+                return Array.from(
+                    document.querySelectorAll(arguments[0]),
+                    (image) => image.getAttribute("style"),
+                );
+                """,
+                f"{TASK_IMAGE[1]} .image",
+            )
 
-        self.driver.switch_to.frame(self.captcha_frame)
+            if not image_styles or None in image_styles:
+                time.sleep(RETRY_DELAY)
+                return
 
-        # Getting the images for the captcha solver.
-        images = self.driver.find_elements(By.XPATH, TASK_IMAGE)
+            url_matches = [_BG_URL_RE.search(image_style) for image_style in image_styles]
 
-        headers: dict[str, str] = {
-            "Authority": "hcaptcha.com",
-            "Accept": "application/json",
-            "Accept-Language": "en-US,en;q=0.9",
-            "Content-Type": "application/json",
-            "Origin": "https://newassets.hcaptcha.com/",
-            "Sec-Fetch-Site": "same-site",
-            "Sec-Fetch-Mode": "cors",
-            "Sec-Fetch-Dest": "empty",
-            "User-Agent": self.user_agent,
-        }
+            if None in url_matches:
+                time.sleep(RETRY_DELAY)
+                return
 
-        image_data: dict[int, str] = {}
+            urls: list[str] = [match.group(1) for match in url_matches]
 
-        # Populating data for the API call.
-        for index, image in enumerate(images):
-            image_style: str | None = image.find_element(
-                By.CLASS_NAME,
-                "image",
-            ).get_attribute("style")
+            # Populating data for the API call.
+            image_data = self.fetch_images(urls, self._tile_headers)
 
-            if image_style is None:
+            if image_data is None:
+                time.sleep(RETRY_DELAY)
                 return
 
-            url: str = re.split(r'[(")]', image_style)[2]
-            img_base64: bytes = base64.b64encode(
-                requests.get(
-                    url,
-                    headers=headers,
-                    timeout=2,
-                ).content
+            # Doing final formating for api by adding mandatory fields.
+            data_to_send = {
+                "target": self.target,
+                "method": "hcaptcha_base64",
+                "sitekey": "sitekey",
+                "site": "site",
+                "images": image_data,
+            }
+
+            # Post the problem and get the solution.
+            r: Response = self._session.post(
+                url=self.ep.solve,
+                headers=self._post_headers,
+                data=dumps(data_to_send),
+                timeout=REQUEST_TIMEOUT,
             )
-            img_base64_decoded: str = img_base64.decode("utf-8")
-            image_data[index] = img_base64_decoded
-
-        # Doing final formating for api by adding mandatory fields.
-        data_to_send = {
-            "target": self.target,
-            "method": "hcaptcha_base64",
-            "sitekey": "sitekey",
-            "site": "site",
-            "images": image_data,
-        }
 
-        # Post the problem and get the solution.
-        r: Response = requests.post(
-            url=self.api_endpoints[1],
-            headers={
-                "Content-Type": "application/json",
-                "apikey": self.api_key,
-            },
-            data=dumps(data_to_send),
-            timeout=2,
-        )
+            # Decrease the requests_left counter.
+            self.requests_left -= 1
 
-        # Decrease the requests_left counter.
-        self.requests_left -= 1
+            # Error pages from the API or a gateway aren't JSON, treat them like an error status.
+            response: dict = loads(r.content) if r.ok else {"status": "error"}
 
-        if r.json()["status"] == "solved":
-            solution = r.json()["solution"]
-            correct_images: list[int] = list(map(int, solution))
+            if response["status"] == "solved":
+                solution = response["solution"]
+                correct_images: list[int] = list(map(int, solution))
 
-            for index in correct_images:
-                self.driver.execute_script("arguments[0].click();", images[index])
-                time.sleep(random.uniform(0.2, 0.25))
+                signature: str = self.challenge_signature()
 
-            button = self.driver.find_element(By.XPATH, CAPTCHA_SUBMIT_BUTTON)
+                # Click all the correct images in a single call, keeping a random delay between clicks.
+                # Once the clicks are done, the same call reads the title of the submit button and clicks it.
+                label: str | None = self.driver.execute_async_script(
+                    """
+                    const [indexes, imageSelector, buttonSelector, done] = arguments;
+                    const images = document.querySelectorAll(imageSelector);
 
-            label: str | None = button.get_attribute("title")
+                    let delay = 0;
+                    for (const index of indexes) {
+                        setTimeout(() => images[index].click(), delay);
+                        delay += 200 + Math.random() * 50;
+                    }
 
-            time.sleep(0.5)
+                    setTimeout(() => {
+                        const button = document.querySelector(buttonSelector);
+                        if (!button) return done(null);
 
-            button.click()
-            self.driver.switch_to.default_content()
+                        const title = button.title;
+                        button.click();
+                        done(title);
+                    }, delay);
+                    """,
+                    correct_images,
+                    TASK_IMAGE[1],
+                    CAPTCHA_SUBMIT_BUTTON[1],
+                )
 
-            # Checking if there's another step to solve.
-            if "Next" in label:
-                self.solve_hcaptcha_grid()
+                self._leave_frame()
 
-        elif r.json()["status"] in ["skip", "error"]:
-            self.driver.find_element(By.XPATH, CAPTCHA_REFRESH_BUTTON).click()
-            self.driver.switch_to.default_content()
+                # Wait for hCaptcha to close the challenge or load the next round,
+                # otherwise the submitted round would be read (and paid for) again.
+                self.wait_for_round_change(signature)
+
+                # Checking if there's another step to solve.
+                if label and "Next" in label:
+                    continue
+
+            elif response["status"] in _BAD_STATUSES:
+                self.driver.find_element(*CAPTCHA_REFRESH_BUTTON).click()
+                self._leave_frame()
 
-            time.sleep(1)
+                time.sleep(REFRESH_DELAY)
+
+            return
 
     def solve_hcaptcha_bbox(
         self,
@@ -277,17 +631,14 @@ class Solver:
         """
         Solves the captcha challenge of type Bounding Box (type = 1).
         """
-        time.sleep(1)
-
-        if not self.is_challenge_image_clickable(wait=1):
-            self.solved = True
-            return
-
         # To get the image url, we have to draw a new canvas using the existing one
-        # and then use toDataURL() to get the image url in base64.
+        # and then encode it to base64. When available, the canvas is resized with
+        # createImageBitmap and encoded from an OffscreenCanvas, so neither step blocks the page.
         get_image_base64 = """
-            function sliceOG() {
-                const originalCanvas = document.querySelector("canvas");
+            const [canvasSelector, done] = arguments;
+
+            async function sliceOG() {
+                const originalCanvas = document.querySelector(canvasSelector);
                 if (!originalCanvas) return null;
 
                 const [originalWidth, originalHeight] = [
@@ -296,137 +647,170 @@ class Solver:
                 ];
                 const scaleFactor = Math.min(500 / originalWidth, 536 / originalHeight);
                 const [outputWidth, outputHeight] = [
-                    originalWidth * scaleFactor,
-                    originalHeight * scaleFactor,
+                    Math.round(originalWidth * scaleFactor),
+                    Math.round(originalHeight * scaleFactor),
                 ];
 
-                const outputCanvas = document.createElement("canvas");
-                Object.assign(outputCanvas, { width: outputWidth, height: outputHeight });
-
-                const ctx = outputCanvas.getContext("2d");
-                ctx.drawImage(
-                    originalCanvas,
-                    0,
-                    0,
-                    originalWidth,
-                    originalHeight,
-                    0,
-                    0,
-                    outputWidth,
-                    outputHeight
-                );
-
-                return outputCanvas
-                    .toDataURL("image/jpeg", 0.4)
-                    .replace(/^data:image\\/(png|jpeg);base64,/, "");
+                let blob;
+                if (typeof OffscreenCanvas !== "undefined" && window.createImageBitmap) {
+                    const bitmap = await createImageBitmap(originalCanvas, {
+                        resizeWidth: outputWidth,
+                        resizeHeight: outputHeight,
+                        resizeQuality: "high",
+                    });
+
+                    const outputCanvas = new OffscreenCanvas(outputWidth, outputHeight);
+                    outputCanvas.getContext("2d").drawImage(bitmap, 0, 0);
+                    bitmap.close();
+
+                    blob = await outputCanvas.convertToBlob({ type: "image/jpeg", quality: 0.4 });
+                } else {
+                    const outputCanvas = document.createElement("canvas");
+                    Object.assign(outputCanvas, { width: outputWidth, height: outputHeight });
+
+                    const ctx = outputCanvas.getContext("2d");
+                    ctx.drawImage(
+                        originalCanvas,
+                        0,
+                        0,
+                        originalWidth,
+                        originalHeight,
+                        0,
+                        0,
+                        outputWidth,
+                        outputHeight
+                    );
+
+                    blob = await new Promise((resolve) => outputCanvas.toBlob(resolve, "image/jpeg", 0.4));
+                }
+
+                // Base64 of the blob, without the data url prefix.
+                return await new Promise((resolve) => {
+                    const reader = new FileReader();
+                    reader.onloadend = () => resolve(reader.result.split(",")[1]);
+                    reader.readAsDataURL(blob);
+                });
             }
 
-            return sliceOG();
+            sliceOG().then(done, () => done(null));
         """
 
-        # Get captcha frame.
-        self.captcha_frame = self.driver.find_element(By.XPATH, HOOK_CHALLENGE)
+        # Loop while there are more steps ("Next Challenge") to solve.
+        while True:
+            if not self.is_challenge_ready():
+                self.solved = True
+                return
 
-        self.driver.switch_to.frame(self.captcha_frame)
+            # Switch to the captcha iframe.
+            self._enter_frame()
 
-        image_base64: str = self.driver.execute_script(get_image_base64)
+            image_base64: str = self.driver.execute_async_script(get_image_base64, CAPTCHA_CANVAS[1])
 
-        if not image_base64:
-            return
+            if not image_base64:
+                time.sleep(RETRY_DELAY)
+                return
 
-        data_to_send = {
-            "target": self.target,
-            "method": "hcaptcha_base64",
-            "sitekey": "sitekey",
-            "site": "site",
-            "type": "bbox",
-            "choices": [],
-            "ln": "en",
-            "images": {
-                0: image_base64,
-            },
-        }
+            data_to_send = {
+                "target": self.target,
+                "method": "hcaptcha_base64",
+                "sitekey": "sitekey",
+                "site": "site",
+                "type": "bbox",
+                "choices": [],
+                "ln": "en",
+                "images": {
+                    0: image_base64,
+                },
+            }
 
-        # Post the problem.
-        post_response: Response = requests.post(
-            url=self.api_endpoints[1],
-            headers={
-                "Content-Type": "application/json",
-                "apikey": self.api_key,
-            },
-            data=dumps(data_to_send),
-            timeout=2,
-        )
+            # Post the problem.
+            post_response: Response = self._session.post(
+                url=self.ep.solve,
+                headers=self._post_headers,
+                data=dumps(data_to_send),
+                timeout=REQUEST_TIMEOUT,
+            )
 
-        # Decrease the requests_left counter.
-        self.requests_left -= 1
+            # Decrease the requests_left counter.
+            self.requests_left -= 1
 
-        if post_response.json()["status"] == "error":
-            # Click on captcha reload button.
-            self.driver.find_element(By.XPATH, CAPTCHA_REFRESH_BUTTON).click()
-            self.driver.switch_to.default_content()
-            return
+            # Error pages from the API or a gateway aren't JSON, treat them like an error status.
+            post_json: dict = loads(post_response.content) if post_response.ok else {"status": "error"}
 
-        headers: dict[str, str] = {
-            "Accept-Language": "last-requested-languages",
-            "apikey": self.api_key,
-        }
+            if post_json["status"] == "error":
+                # Click on captcha reload button.
+                self.driver.find_element(*CAPTCHA_REFRESH_BUTTON).click()
+                self._leave_frame()
+                return
 
-        url: str = post_response.json()["url"]
+            url: str = post_json["url"]
 
-        # Wait for the solution.
-        while True:
-            time.sleep(0.2)
+            delay: float = SOLUTION_POLL_DELAY
+            deadline: float = time.monotonic() + SOLUTION_POLL_TIMEOUT
 
-            solve_response: Response = requests.get(
-                url=url,
-                headers=headers,
-                timeout=1,
-            )
+            # Wait for the solution, backing off between polls.
+            while True:
+                time.sleep(delay)
+                delay = min(delay * 1.5, SOLUTION_POLL_MAX_DELAY)
 
-            if solve_response.json()["status"] in ["error", "skip"]:
-                self.driver.find_element(By.XPATH, CAPTCHA_REFRESH_BUTTON).click()
-                self.driver.switch_to.default_content()
+                poll_response: Response = self._session.get(
+                    url=url,
+                    headers=self._poll_headers,
+                    timeout=REQUEST_TIMEOUT,
+                )
 
-                time.sleep(1)
+                solve_json: dict = loads(poll_response.content) if poll_response.ok else {"status": "error"}
 
-                return
+                if solve_json["status"] == "solved":
+                    break
 
-            if solve_response.json()["status"] == "solved":
-                break
+                if solve_json["status"] in _BAD_STATUSES or time.monotonic() > deadline:
+                    self.driver.find_element(*CAPTCHA_REFRESH_BUTTON).click()
+                    self._leave_frame()
 
-        x_pos, y_pos = solve_response.json()["answer"]
+                    time.sleep(REFRESH_DELAY)
 
-        canvas = self.driver.find_element(By.XPATH, CAPTCHA_CANVAS)
+                    return
 
-        # This always clicks in the center,
-        # so we need to move the cursor negative pixels or positive depending
-        # on the response from the API.
-        move_by_x: int = canvas.size["width"] / 2 - x_pos
-        move_by_y: int = canvas.size["height"] / 2 - y_pos
+            x_pos, y_pos = solve_json["answer"]
 
-        action = webdriver.common.action_chains.ActionChains(self.driver)
-        action.move_to_element(
-            canvas,
-        ).move_by_offset(
-            move_by_x * -1,
-            move_by_y * -1,
-        ).click().perform()
+            canvas = self.driver.find_element(*CAPTCHA_CANVAS)
 
-        time.sleep(0.5)
+            size: dict[str, int] = canvas.size
 
-        button = self.driver.find_element(By.XPATH, CAPTCHA_SUBMIT_BUTTON)
+            # Offsets of move_to_element_with_offset are from the center of the element,
+            # so we need to move the cursor negative pixels or positive depending
+            # on the response from the API. Everything is sent in a single perform().
+            ActionChains(self.driver).move_to_element_with_offset(
+                canvas,
+                int(x_pos - size["width"] / 2),
+                int(y_pos - size["height"] / 2),
+            ).click().perform()
 
-        label: str | None = button.get_attribute("title")
+            signature: str = self.challenge_signature()
 
-        time.sleep(0.5)
+            # Read the title of the submit button and click it in a single call.
+            label: str | None = self.driver.execute_script(
+                """
+                const button = document.querySelector(arguments[0]);
+                if (!button) return null;
 
-        button.click()
-        self.driver.switch_to.default_content()
+                const title = button.title;
+                button.click();
+                return title;
+                """,
+                CAPTCHA_SUBMIT_BUTTON[1],
+            )
+
+            self._leave_frame()
+
+            # Wait for hCaptcha to close the challenge or load the next round,
+            # otherwise the submitted round would be read (and paid for) again.
+            self.wait_for_round_change(signature)
 
-        # Checking if there's another step to solve.
-        if label == "Next Challenge":
-            self.solve_hcaptcha_bbox()
+            # Checking if there's another step to solve.
+            if label != "Next Challenge":
+                return
 
     def has_balance(
         self,
@@ -437,29 +821,34 @@ class Solver:
         Returns:
             bool: True if the user has balance, False otherwise.
         """
-        response: Response = requests.get(
-            self.api_endpoints[0],
-            headers={"apikey": self.api_key},
-            timeout=2,
-        )
+        # Transient failures are already retried by the session.
+        try:
+            response: Response = self._session.get(
+                self.ep.balance,
+                headers=self._balance_headers,
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException:
+            self.api_error = True
+            return
 
-        if not response:
+        if not response.ok:
             self.api_error = True
             return
 
-        res_json: list = response.json()
+        res_json: list = loads(response.content)
 
         # Check if request was successful.
         if "error" in res_json:
             print(res_json["error"])
             return
 
-        if self.api_url == "pro" and "Subscription" in res_json and "Balance" in res_json:
+        if self.api_plan == "pro" and "Subscription" in res_json and "Balance" in res_json:
             self.balance = res_json["Balance"]
             self.requests_left = res_json["Subscription"]["remaining"]
             return
 
-        if self.api_url == "free" and "remaining" in res_json:
+        if self.api_plan == "free" and "remaining" in res_json:
             self.balance = 0
             self.requests_left = res_json["remaining"]
             return
@@ -481,36 +870,55 @@ class Solver:
         Returns:
             bool: True if the captcha was solved, False otherwise.
         """
-        # Save the page object.
+        # Save the page object and make sure to start from the main frame.
         self.driver = driver
+        self.driver.switch_to.default_content()
+        self._in_frame = False
 
-        self.user_agent = self.driver.execute_script("return navigator.userAgent")
+        user_agent: str | None = self._ua_by_driver.get(driver)
 
-        while not self.solved:
-            self.has_balance()
+        if user_agent is None:
+            user_agent = self._ua_by_driver[driver] = self.driver.execute_script("return navigator.userAgent")
 
-            # Check if user has balance or daily limit hasn't been hit.
-            if self.balance <= 0 and self.requests_left <= 0:
-                self.api_error = True
-                print("No balance/requests left on your nocatpchaAI account.")
-                return self.solved
+        if user_agent != self.user_agent:
+            self.user_agent = user_agent
 
-            # If captcha is not visible it means it has been solved.
-            if not self.is_captcha_visible():
-                self.solved = True
-                break
+            # Headers used to download the grid images, with the user agent of the browser.
+            self._tile_headers = {**_IMG_GET_HEADERS, "User-Agent": self.user_agent}
 
-            # Identify the type of captcha.
-            self.identify_challenge()
-
-            match self.captcha_type:
-                case 0:
-                    self.solve_hcaptcha_grid()
-                case 1:
-                    self.solve_hcaptcha_bbox()
-                case 2:
+        # Whatever happens, don't leave the caller inside the captcha iframe.
+        try:
+            while not self.solved:
+                # Between checks rely on the locally decremented requests_left.
+                if self._balance_checked_at is None or time.monotonic() - self._balance_checked_at > BALANCE_CHECK_TTL:
+                    self.has_balance()
+                    self._balance_checked_at = time.monotonic()
+
+                # Check if user has balance or daily limit hasn't been hit.
+                if self.balance <= 0 and self.requests_left <= 0:
+                    self.api_error = True
+                    print("No balance/requests left on your nocatpchaAI account.")
+                    return self.solved
+
+                # If captcha is not visible it means it has been solved.
+                if not self.is_captcha_visible():
+                    self.solved = True
                     break
 
-            time.sleep(2)
+                # Identify the type of captcha.
+                self.identify_challenge()
+
+                match self.captcha_type:
+                    case 0:
+                        self.solve_hcaptcha_grid()
+                    case 1:
+                        self.solve_hcaptcha_bbox()
+                    case 2:
+                        break
+                    case _:
+                        # Unknown challenge, give it some time before checking again.
+                        time.sleep(RETRY_DELAY)
+        finally:
+            self._leave_frame()
 
         return self.solved
@@ -36,15 +36,14 @@ def main() -> None:
         options=options,
     )
 
-    captcha_solver = Solver()
+    with Solver() as captcha_solver:
+        while not captcha_solver.solved:
+            driver.get("https://nocaptchaai.com/demo/hcaptcha.html")
 
-    while not captcha_solver.solved:
-        driver.get("https://nocaptchaai.com/demo/hcaptcha.html")
+            captcha_solver.solve(driver)
 
-        captcha_solver.solve(driver)
-
-        if captcha_solver.api_error:
-            break
+            if captcha_solver.api_error:
+                break
 
     print("Solved")
 
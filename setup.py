@@ -23,6 +23,9 @@ setup(
         "selenium",
         "requests",
     ],
+    extras_require={
+        "fast": ["orjson"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",